@@ -6,40 +6,71 @@
 # where <RUN> is either 20251026T170002Z or 20251026170002.
 # Output:
 #   gs://<bucket>/<STRUCTURED_PREFIX>/run_id=<RUN>/jsonl/<post_id>.jsonl
+#   gs://<bucket>/<STRUCTURED_PREFIX>/run_id=<RUN>/aggregate.ndjson   (compose of all the above)
 
 import os
 import re
 import json
 import logging
-import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
+import orjson
 from flask import Request, jsonify
 from google.api_core import retry as gax_retry
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 
 # -------------------- ENV --------------------
 PROJECT_ID         = os.getenv("PROJECT_ID")
 BUCKET_NAME        = os.getenv("GCS_BUCKET")                        # REQUIRED
 SCRAPES_PREFIX     = os.getenv("SCRAPES_PREFIX", "scrapes")         # input
 STRUCTURED_PREFIX  = os.getenv("STRUCTURED_PREFIX", "structured")   # output
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", "32"))   # parallel listings
 
 # Accept BOTH run id styles:
 RUN_ID_ISO_RE   = re.compile(r"^\d{8}T\d{6}Z$")  # 20251026T170002Z
 RUN_ID_PLAIN_RE = re.compile(r"^\d{14}$")        # 20251026170002
+RUN_ID_ANY_RE   = re.compile(r"^(?:\d{8}T\d{6}Z|\d{14})$")  # either style, one match
 
 READ_RETRY = gax_retry.Retry(
     predicate=gax_retry.if_transient_error,
     initial=1.0, maximum=10.0, multiplier=2.0, deadline=120.0
 )
 
+COMPOSE_MAX_SOURCES = 32  # GCS compose() limit per call
+LIST_FIELDS = "items(name),prefixes,nextPageToken"  # partial listing response: names only
+
 storage_client = storage.Client()
 
+def _size_http_pool(client: storage.Client, maxsize: int):
+    """
+    requests keeps only DEFAULT_POOLSIZE (10) connections per host; with more
+    worker threads than that, extra connections are discarded ("Connection pool
+    is full") and every request re-opens TLS. Size the pool to the thread count.
+    An mTLS session keeps its own adapter.
+    """
+    session = client._http
+    if maxsize > DEFAULT_POOLSIZE and not getattr(session, "is_mtls", False):
+        session.mount("https://", HTTPAdapter(pool_connections=DEFAULT_POOLSIZE, pool_maxsize=maxsize))
+
+_size_http_pool(storage_client, EXTRACT_CONCURRENCY)
+
 # -------------------- SIMPLE REGEX EXTRACTORS --------------------
+# Each field gets its own search so it sees the whole text (and its own first
+# match): fields overlap ("$2015", "2000 miles", "Low Mileage: 50,000"), which a
+# single non-overlapping finditer scan cannot honour.
 PRICE_RE      = re.compile(r"\$\s?([0-9,]+)")
 YEAR_RE       = re.compile(r"\b(19|20)\d{2}\b")
 MAKE_MODEL_RE = re.compile(r"\b([A-Z][a-z]+)\s+([A-Z][A-Za-z0-9]+)")
 
+# mileage variants, tried in this order
+MILEAGE_LABEL_RE = re.compile(r"(?:mileage|odometer)\s*[:\-]?\s*([\d,]+)", re.I)
+MILEAGE_K_RE     = re.compile(r"(\d+(?:\.\d+)?)\s*k\s*(?:mi|mile|miles)\b", re.I)
+MILEAGE_PLAIN_RE = re.compile(r"(\d{1,3}(?:[,\d]{3})*)\s*(?:mi|mile|miles)\b", re.I)
+_DIGITS_RE       = re.compile(r"[^\d]")
+
 # -------------------- HELPERS --------------------
 def _list_run_ids(bucket: str, scrapes_prefix: str) -> list[str]:
     """
@@ -48,7 +79,7 @@ def _list_run_ids(bucket: str, scrapes_prefix: str) -> list[str]:
       - <scrapes_prefix>/run_id=20251026T170002Z/
       - <scrapes_prefix>/20251026170002/
     """
-    it = storage_client.list_blobs(bucket, prefix=f"{scrapes_prefix}/", delimiter="/")
+    it = storage_client.list_blobs(bucket, prefix=f"{scrapes_prefix}/", delimiter="/", fields=LIST_FIELDS)
     for _ in it:
         pass  # populate it.prefixes
 
@@ -57,20 +88,28 @@ def _list_run_ids(bucket: str, scrapes_prefix: str) -> list[str]:
         # e.g., 'scrapes/run_id=20251026T170002Z/' OR 'scrapes/20251026170002/'
         tail = pref.rstrip("/").split("/")[-1]
         cand = tail.split("run_id=", 1)[1] if tail.startswith("run_id=") else tail
-        if RUN_ID_ISO_RE.match(cand) or RUN_ID_PLAIN_RE.match(cand):
+        if RUN_ID_ANY_RE.match(cand):
             run_ids.append(cand)
     return sorted(run_ids)
 
 def _txt_objects_for_run(run_id: str) -> list[str]:
     """
     Return .txt object names for a given run_id.
-    Tries (in order) and returns the first non-empty list:
+    Lists both run folder styles in ONE request (match_glob filters server-side),
+    then returns the first non-empty group in this order:
       scrapes/run_id=<run_id>/txt/
       scrapes/run_id=<run_id>/
       scrapes/<run_id>/txt/
       scrapes/<run_id>/
     """
     bucket = storage_client.bucket(BUCKET_NAME)
+    all_names = [
+        b.name for b in bucket.list_blobs(
+            prefix=f"{SCRAPES_PREFIX}/",
+            match_glob=f"{SCRAPES_PREFIX}/{{run_id={run_id},{run_id}}}/**.txt",
+            fields=LIST_FIELDS,
+        )
+    ]
     candidates = [
         f"{SCRAPES_PREFIX}/run_id={run_id}/txt/",
         f"{SCRAPES_PREFIX}/run_id={run_id}/",
@@ -78,7 +117,7 @@ def _txt_objects_for_run(run_id: str) -> list[str]:
         f"{SCRAPES_PREFIX}/{run_id}/",
     ]
     for pref in candidates:
-        names = [b.name for b in bucket.list_blobs(prefix=pref) if b.name.endswith(".txt")]
+        names = [n for n in all_names if n.startswith(pref)]
         if names:
             return names
     return []
@@ -88,11 +127,78 @@ def _download_text(blob_name: str) -> str:
     blob = bucket.blob(blob_name)
     return blob.download_as_text(retry=READ_RETRY, timeout=120)
 
-def _upload_jsonl_line(blob_name: str, record: dict):
+def _upload_jsonl_line(blob_name: str, record: dict, overwrite: bool = True) -> bool:
+    """
+    Upload one JSONL record. With overwrite=False the upload is conditional on the
+    object not existing yet (if_generation_match=0), so no separate exists() call
+    is needed. Returns False if the object was already there.
+    """
     bucket = storage_client.bucket(BUCKET_NAME)
     blob = bucket.blob(blob_name)
-    line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
-    blob.upload_from_string(line, content_type="application/x-ndjson")
+    try:
+        line = orjson.dumps(record) + b"\n"  # compact, UTF-8
+    except TypeError:
+        # orjson rejects ints outside 64 bits (e.g. a 21-digit "price"); json.dumps
+        # doesn't, and gives the same compact UTF-8 form
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+    if overwrite:
+        blob.upload_from_string(line, content_type="application/x-ndjson")
+        return True
+    try:
+        blob.upload_from_string(line, content_type="application/x-ndjson", if_generation_match=0)
+    except PreconditionFailed:
+        return False
+    return True
+
+def _jsonl_keys_for_run(run_id: str) -> list[str]:
+    """Return every per-listing .jsonl object name already written for run_id."""
+    bucket = storage_client.bucket(BUCKET_NAME)
+    prefix = f"{STRUCTURED_PREFIX}/run_id={run_id}/jsonl/"
+    return sorted(b.name for b in bucket.list_blobs(prefix=prefix, fields=LIST_FIELDS)
+                  if b.name.endswith(".jsonl"))
+
+def _delete_run_aggregate(run_id: str):
+    """Remove run_id=<run_id>/aggregate.ndjson (if any) so readers use the per-listing files."""
+    try:
+        storage_client.bucket(BUCKET_NAME).blob(
+            f"{STRUCTURED_PREFIX}/run_id={run_id}/aggregate.ndjson"
+        ).delete()
+    except NotFound:
+        pass
+
+def _compose_run_aggregate(run_id: str, source_keys: list[str]) -> str:
+    """
+    Concatenate the per-listing .jsonl objects into run_id=<run_id>/aggregate.ndjson
+    so the materializer can read one object per run instead of one per listing.
+    compose() takes at most 32 sources, so larger runs are composed into
+    aggregates/part-XXXX.ndjson first, level by level, until 32 or fewer remain.
+    Once the final compose succeeds everything under aggregates/ is deleted,
+    including parts left by earlier or interrupted invocations.
+    """
+    bucket = storage_client.bucket(BUCKET_NAME)
+    base = f"{STRUCTURED_PREFIX}/run_id={run_id}"
+    sources = [bucket.blob(k) for k in source_keys]
+    n_parts = 0
+    while len(sources) > COMPOSE_MAX_SOURCES:
+        parts = []
+        for i in range(0, len(sources), COMPOSE_MAX_SOURCES):
+            part = bucket.blob(f"{base}/aggregates/part-{n_parts:04d}.ndjson")
+            part.content_type = "application/x-ndjson"
+            part.compose(sources[i:i + COMPOSE_MAX_SOURCES])
+            parts.append(part)
+            n_parts += 1
+        sources = parts
+
+    dest = bucket.blob(f"{base}/aggregate.ndjson")
+    dest.content_type = "application/x-ndjson"
+    dest.compose(sources)
+
+    try:
+        parts = list(bucket.list_blobs(prefix=f"{base}/aggregates/", fields=LIST_FIELDS))
+        bucket.delete_blobs(parts, on_error=lambda blob: None)  # ignore already-gone parts
+    except Exception:
+        logging.exception("Failed to delete intermediate aggregate parts for %s", run_id)
+    return dest.name
 
 def _parse_run_id_as_iso(run_id: str) -> str:
     """Normalize either run_id style to ISO8601 Z (fallback = now UTC)."""
@@ -132,19 +238,19 @@ def parse_listing(text: str) -> dict:
 
     # mileage variants
     mi = None
-    m1 = re.search(r"(?:mileage|odometer)\s*[:\-]?\s*([\d,]+)", text, re.I)
+    m1 = MILEAGE_LABEL_RE.search(text)
     if m1:
         try: mi = int(m1.group(1).replace(",", ""))
         except ValueError: mi = None
     if mi is None:
-        m2 = re.search(r"(\d+(?:\.\d+)?)\s*k\s*(?:mi|mile|miles)\b", text, re.I)
+        m2 = MILEAGE_K_RE.search(text)
         if m2:
             try: mi = int(float(m2.group(1)) * 1000)
             except ValueError: mi = None
     if mi is None:
-        m3 = re.search(r"(\d{1,3}(?:[,\d]{3})*)\s*(?:mi|mile|miles)\b", text, re.I)
+        m3 = MILEAGE_PLAIN_RE.search(text)
         if m3:
-            try: mi = int(re.sub(r"[^\d]", "", m3.group(1)))
+            try: mi = int(_DIGITS_RE.sub("", m3.group(1)))
             except ValueError: mi = None
     if mi is not None:
         d["mileage"] = mi
@@ -188,15 +294,32 @@ def extract_http(request: Request):
     if max_files > 0:
         txt_blobs = txt_blobs[:max_files]
 
-    processed = written = skipped = errors = 0
-    bucket = storage_client.bucket(BUCKET_NAME)
+    # Bind hot-loop globals and the per-run output prefix once; the worker then
+    # reads them as closure cells instead of module-global lookups per listing.
+    download, parse, upload = _download_text, parse_listing, _upload_jsonl_line
+    out_prefix = f"{STRUCTURED_PREFIX}/run_id={run_id}/jsonl/"
+
+    # One listing up front instead of an existence check per listing; it also
+    # seeds the aggregate below, so jsonl/ is not listed a second time.
+    existing = set(_jsonl_keys_for_run(run_id))
+
+    # Invalidate the aggregate before writing anything: if this invocation dies
+    # before re-composing it, the materializer falls back to the per-listing
+    # files instead of trusting an aggregate that misses the new records.
+    _delete_run_aggregate(run_id)
+
+    def _process_one(name: str) -> tuple[str, str]:
+        """Download, parse and upload one listing; returns ("written" | "skipped" | "error", out_key)."""
+        # names come from _txt_objects_for_run, so always "/"-separated and ".txt"
+        post_id = name[name.rfind("/") + 1:-4]
+        out_key = f"{out_prefix}{post_id}.jsonl"
+        if not overwrite and out_key in existing:
+            return "skipped", out_key
 
-    for name in txt_blobs:
         try:
-            text = _download_text(name)
-            fields = parse_listing(text)
+            text = download(name)
+            fields = parse(text)
 
-            post_id = os.path.splitext(os.path.basename(name))[0]
             record = {
                 "post_id": post_id,
                 "run_id": run_id,
@@ -205,28 +328,44 @@ def extract_http(request: Request):
                 **fields,
             }
 
-            out_key = f"{STRUCTURED_PREFIX}/run_id={run_id}/jsonl/{post_id}.jsonl"
-
-            if not overwrite and bucket.blob(out_key).exists():
-                skipped += 1
-            else:
-                _upload_jsonl_line(out_key, record)
-                written += 1
-
-        except Exception as e:
-            errors += 1
-            logging.error(f"Failed {name}: {e}\n{traceback.format_exc()}")
-
-        processed += 1
+            # still conditional: another invocation may have written it meanwhile
+            if upload(out_key, record, overwrite=overwrite):
+                return "written", out_key
+            return "skipped", out_key
+
+        except Exception:
+            logging.exception("Failed %s", name)
+            return "error", out_key
+
+    # storage_client is thread-safe; every worker shares it
+    counters = {"written": 0, "skipped": 0, "error": 0}
+    jsonl_keys = set(existing)
+    with ThreadPoolExecutor(max_workers=EXTRACT_CONCURRENCY) as ex:
+        for status, out_key in ex.map(_process_one, txt_blobs):
+            counters[status] += 1
+            if status != "error":
+                jsonl_keys.add(out_key)
+
+    # Rebuild the per-run aggregate from everything under jsonl/ (the upfront
+    # listing plus this invocation's writes) so max_files / overwrite=false runs
+    # stay complete.
+    aggregate_key = None
+    try:
+        if jsonl_keys:
+            aggregate_key = _compose_run_aggregate(run_id, sorted(jsonl_keys))
+    except Exception:
+        # the aggregate was already removed above, so readers use the per-listing files
+        logging.exception("Failed to compose aggregate for %s", run_id)
 
     result = {
         "ok": True,
         "version": "extractor-v3-jsonl-flex",
         "run_id": run_id,
-        "processed_txt": processed,
-        "written_jsonl": written,
-        "skipped_existing": skipped,
-        "errors": errors
+        "processed_txt": len(txt_blobs),
+        "written_jsonl": counters["written"],
+        "skipped_existing": counters["skipped"],
+        "errors": counters["error"],
+        "aggregate": f"gs://{BUCKET_NAME}/{aggregate_key}" if aggregate_key else None
     }
     logging.info(json.dumps(result))
     return jsonify(result), 200
@@ -0,0 +1,57 @@
+# test_main.py
+# Regression cases for parse_listing. Run from this folder:
+#   python -m unittest test_main
+
+import unittest
+from unittest import mock
+
+with mock.patch("google.cloud.storage.Client"):  # no GCS credentials needed
+    import main
+
+
+class ParseListingTest(unittest.TestCase):
+    CASES = [
+        # make/model must not swallow the mileage label
+        ("Low Mileage: 50,000",
+         {"make": "Low", "model": "Mileage", "mileage": 50000}),
+        ("2015 Honda Civic, Actual Mileage: 85,000",
+         {"year": 2015, "make": "Honda", "model": "Civic", "mileage": 85000}),
+        # overlapping fields each see the whole text
+        ("Price $2015", {"price": 2015, "year": 2015}),
+        ("Mileage: 2015 then built 2010", {"year": 2015, "mileage": 2015}),
+        ("2000 miles on it", {"year": 2000, "mileage": 2000}),
+        ("2015 Honda Civic $12,500 odometer: 98,000",
+         {"price": 12500, "year": 2015, "make": "Honda", "model": "Civic", "mileage": 98000}),
+        ("Toyota Camry 2012, 45.5k miles, asking $8000",
+         {"price": 8000, "year": 2012, "make": "Toyota", "model": "Camry", "mileage": 45500}),
+        ("nothing here", {}),
+        # get_text() keeps &nbsp; as \xa0; Unicode \s / \d / \b must still apply
+        ("Price: $\xa012,500", {"price": 12500}),
+        ("Mileage:\xa050,000", {"mileage": 50000}),
+        ("45k\xa0miles", {"mileage": 45000}),
+        ("120,000\xa0mi", {"mileage": 120000}),
+        ("\u0661\u0662\u0663 miles", {"mileage": 123}),  # Arabic-Indic digits
+        ("caf\xe92015", {}),
+    ]
+
+    def test_parse_listing(self):
+        for text, expected in self.CASES:
+            with self.subTest(text=text):
+                self.assertEqual(main.parse_listing(text), expected)
+
+
+
+class UploadJsonlLineTest(unittest.TestCase):
+    def test_int_beyond_64_bits_still_serialized(self):
+        record = main.parse_listing("Price $123456789012345678901")
+        self.assertEqual(record, {"price": 123456789012345678901})
+
+        blob = main.storage_client.bucket.return_value.blob.return_value
+        blob.reset_mock()
+        self.assertTrue(main._upload_jsonl_line("k.jsonl", record))
+        line = blob.upload_from_string.call_args.args[0]
+        self.assertEqual(line, b'{"price":123456789012345678901}\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
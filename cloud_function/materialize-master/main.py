@@ -1,28 +1,49 @@
 # main.py
 # Build a single, ever-growing CSV from all structured JSONL files.
-# Reads:  gs://<bucket>/<STRUCTURED_PREFIX>/run_id=*/jsonl/*.jsonl
+# Reads:  gs://<bucket>/<STRUCTURED_PREFIX>/run_id=*/aggregate.ndjson  (per-run compose from the extractor)
+#         gs://<bucket>/<STRUCTURED_PREFIX>/run_id=*/jsonl/*.jsonl      (fallback when no aggregate)
 # Writes: gs://<bucket>/<STRUCTURED_PREFIX>/datasets/listings_master.csv  (atomic publish)
 
 import csv
+import functools
 import io
-import json
 import os
 import re
 from datetime import datetime, timezone
-from typing import Dict, Iterable
+from itertools import islice
+from typing import Dict, Iterable, Iterator
 
+import orjson
 from flask import Request, jsonify
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 
 # -------------------- ENV --------------------
 BUCKET_NAME        = os.getenv("GCS_BUCKET")                      # REQUIRED
 STRUCTURED_PREFIX  = os.getenv("STRUCTURED_PREFIX", "structured") # e.g., "structured"
+FETCH_CONCURRENCY  = int(os.getenv("FETCH_CONCURRENCY", "64"))     # parallel .jsonl downloads
 
 storage_client = storage.Client()
 
+def _size_http_pool(client: storage.Client, maxsize: int):
+    """
+    requests keeps only DEFAULT_POOLSIZE (10) connections per host; with more
+    download threads than that, extra connections are discarded ("Connection
+    pool is full") and every request re-opens TLS. Size the pool to the thread
+    count. An mTLS session keeps its own adapter.
+    """
+    session = client._http
+    if maxsize > DEFAULT_POOLSIZE and not getattr(session, "is_mtls", False):
+        session.mount("https://", HTTPAdapter(pool_connections=DEFAULT_POOLSIZE, pool_maxsize=maxsize))
+
+_size_http_pool(storage_client, FETCH_CONCURRENCY)
+
 # Accept BOTH runIDs:
 RUN_ID_ISO_RE   = re.compile(r"^\d{8}T\d{6}Z$")  # 20251026T170002Z
 RUN_ID_PLAIN_RE = re.compile(r"^\d{14}$")        # 20251026170002
+RUN_ID_ANY_RE   = re.compile(r"^(?:\d{8}T\d{6}Z|\d{14})$")  # either style, one match
 
 # Stable CSV schema for students
 CSV_COLUMNS = [
@@ -31,8 +52,13 @@ CSV_COLUMNS = [
     "source_txt"
 ]
 
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024  # resumable-upload chunk (multiple of 256 KiB)
+LIST_FIELDS = "items(name),prefixes,nextPageToken"  # partial listing response: names only
+SINGLE_UPLOAD_MAX = 8 * 1024 * 1024  # client's multipart limit: up to this many bytes go up in one request
+CSV_BATCH_ROWS = 10_000  # rows handed to csv.writer.writerows() at a time
+
 def _list_run_ids(bucket: str, structured_prefix: str) -> list[str]:
-    it = storage_client.list_blobs(bucket, prefix=f"{structured_prefix}/", delimiter="/")
+    it = storage_client.list_blobs(bucket, prefix=f"{structured_prefix}/", delimiter="/", fields=LIST_FIELDS)
     for _ in it:  # populate it.prefixes
         pass
     run_ids = []
@@ -40,29 +66,59 @@ def _list_run_ids(bucket: str, structured_prefix: str) -> list[str]:
         tail = p.rstrip("/").split("/")[-1]           # e.g. run_id=20251026170002
         if tail.startswith("run_id="):
             rid = tail.split("run_id=", 1)[1]
-            if RUN_ID_ISO_RE.match(rid) or RUN_ID_PLAIN_RE.match(rid):
+            if RUN_ID_ANY_RE.match(rid):
                 run_ids.append(rid)
     return sorted(run_ids)
 
+def _parse_jsonl_line(raw: bytes, run_id: str):
+    """Parse one JSON record straight from bytes; returns None for blank or malformed input."""
+    try:
+        rec = orjson.loads(raw)  # tolerates surrounding whitespace / trailing newline
+    except orjson.JSONDecodeError:  # includes empty input
+        return None
+    if not isinstance(rec, dict):
+        return None
+    # ensure required keys exist
+    rec.setdefault("run_id", run_id)
+    return rec
+
 def _jsonl_records_for_run(bucket: str, structured_prefix: str, run_id: str):
-    """Yield dict records from .jsonl under .../run_id=<run_id>/jsonl/ (one JSON per file)."""
+    """
+    Yield dict records for one run. Reads run_id=<run_id>/aggregate.ndjson in a single
+    GET when the extractor composed one; otherwise falls back to the per-listing
+    .jsonl files under .../run_id=<run_id>/jsonl/ (one JSON per file).
+    """
     b = storage_client.bucket(bucket)
+    try:
+        data = b.blob(f"{structured_prefix}/run_id={run_id}/aggregate.ndjson").download_as_bytes()
+    except NotFound:
+        data = None
+    if data is not None:
+        for line in data.splitlines():
+            rec = _parse_jsonl_line(line, run_id)
+            if rec is not None:
+                yield rec
+        return
+
     prefix = f"{structured_prefix}/run_id={run_id}/jsonl/"
-    for blob in b.list_blobs(prefix=prefix):
-        if not blob.name.endswith(".jsonl"):
-            continue
-        data = blob.download_as_text()
-        line = data.strip()
-        if not line:
-            continue
-        try:
-            rec = json.loads(line)
-            # ensure required keys exist
-            rec.setdefault("run_id", run_id)
+    names = [blob.name for blob in b.list_blobs(prefix=prefix, fields=LIST_FIELDS)
+             if blob.name.endswith(".jsonl")]
+
+    # Files are tiny, so per-request latency dominates; let transfer_manager
+    # download them concurrently into in-memory buffers
+    buffers = [io.BytesIO() for _ in names]
+    transfer_manager.download_many(
+        list(zip((b.blob(n) for n in names), buffers)),
+        worker_type=transfer_manager.THREAD,
+        max_workers=FETCH_CONCURRENCY,
+        raise_exception=True,
+    )
+    for buf in buffers:
+        rec = _parse_jsonl_line(buf.getvalue(), run_id)
+        if rec is not None:
             yield rec
-        except Exception:
-            continue
 
+@functools.lru_cache(maxsize=None)
 def _run_id_to_dt(rid: str) -> datetime:
     if RUN_ID_ISO_RE.match(rid):
         return datetime.strptime(rid, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
@@ -71,24 +127,62 @@ def _run_id_to_dt(rid: str) -> datetime:
     # fallback: now
     return datetime.now(timezone.utc)
 
-def _open_gcs_text_writer(bucket: str, key: str):
-    """Open a text-mode writer to GCS; close() will finalize the upload."""
+def _open_gcs_writer(bucket: str, key: str):
+    """
+    Open a binary BlobWriter to GCS. Use it as a context manager: a clean exit
+    finalizes the upload, an exception cancels it (google-cloud-storage >= 3.0),
+    so a failed write never publishes a truncated object.
+    """
     b = storage_client.bucket(bucket)
     blob = b.blob(key)
-    # Text mode avoids the flush/finalize pitfall of binary+TextIOWrapper
-    return blob.open("w")  # newline handled by csv module
+    # 16 MiB chunks instead of the small default mean far fewer upload PUTs
+    return blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type="text/csv")
 
 
 def _write_csv(records: Iterable[Dict], dest_key: str, columns=CSV_COLUMNS) -> int:
+    """
+    Render the CSV in memory, then publish it. Outputs up to SINGLE_UPLOAD_MAX
+    bytes go up as one multipart upload_from_string() request (no resumable
+    session); larger ones are streamed through _open_gcs_writer. Nothing is
+    published if reading records fails part-way.
+    """
     n = 0
-    with _open_gcs_text_writer(BUCKET_NAME, dest_key) as out:
-        w = csv.DictWriter(out, fieldnames=columns, extrasaction="ignore")
-        w.writeheader()
-        for rec in records:
-            row = {c: rec.get(c, None) for c in columns}
-            w.writerow(row)
-            n += 1
-    return n  # close() finalizes the upload
+    buf = io.StringIO(newline="")
+    w = csv.writer(buf)
+    w.writerow(columns)
+    # positional rows; missing keys become None -> "" like DictWriter did
+    rows = ([rec.get(c) for c in columns] for rec in records)
+    writerows = w.writerows
+    while True:
+        batch = list(islice(rows, CSV_BATCH_ROWS))
+        if not batch:
+            break
+        writerows(batch)
+        n += len(batch)
+
+    data = buf.getvalue().encode("utf-8")  # measure bytes, not characters
+    if len(data) <= SINGLE_UPLOAD_MAX:
+        blob = storage_client.bucket(BUCKET_NAME).blob(dest_key)
+        blob.upload_from_string(data, content_type="text/csv")
+        return n
+
+    with _open_gcs_writer(BUCKET_NAME, dest_key) as out:
+        out.write(data)
+    return n  # leaving the with-block finalizes the upload
+
+def _newest_per_post(run_ids: list[str], seen: set[str]) -> Iterator[Dict]:
+    """
+    Walk runs newest first and yield the first record seen per post_id, which is
+    therefore its newest. Only the post_ids in `seen` are kept in memory, and
+    no per-record run_id comparison is needed.
+    """
+    for rid in sorted(run_ids, key=_run_id_to_dt, reverse=True):
+        for rec in _jsonl_records_for_run(BUCKET_NAME, STRUCTURED_PREFIX, rid):
+            pid = rec.get("post_id")
+            if not pid or pid in seen:
+                continue
+            seen.add(pid)
+            yield rec
 
 def materialize_http(request: Request):
     """
@@ -105,24 +199,15 @@ def materialize_http(request: Request):
         if not run_ids:
             return jsonify({"ok": False, "error": f"no runs found under {STRUCTURED_PREFIX}/"}), 200
 
-        latest_by_post: Dict[str, Dict] = {}
-        for rid in run_ids:
-            for rec in _jsonl_records_for_run(BUCKET_NAME, STRUCTURED_PREFIX, rid):
-                pid = rec.get("post_id")
-                if not pid:
-                    continue
-                prev = latest_by_post.get(pid)
-                if (prev is None) or (_run_id_to_dt(rec.get("run_id", rid)) > _run_id_to_dt(prev.get("run_id", ""))):
-                    latest_by_post[pid] = rec
-
+        seen: set[str] = set()
         base = f"{STRUCTURED_PREFIX}/datasets"
         final_key = f"{base}/listings_master.csv"
-        rows = _write_csv(latest_by_post.values(), final_key)
+        rows = _write_csv(_newest_per_post(run_ids, seen), final_key)
 
         return jsonify({
             "ok": True,
             "runs_scanned": len(run_ids),
-            "unique_listings": len(latest_by_post),
+            "unique_listings": len(seen),
             "rows_written": rows,
             "output_csv": f"gs://{BUCKET_NAME}/{final_key}"
         }), 200